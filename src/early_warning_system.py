@@ -1,113 +1,307 @@
 import os
+import re
 import json
 import time
+import asyncio
+import hashlib
+import threading
+import functools
 from datetime import datetime
-from langchain_community.llms import LlamaCpp
+import aiohttp
+import diskcache
+import faiss
+import numpy as np
+from sentence_transformers import SentenceTransformer
+from llama_cpp import Llama, LlamaGrammar
 from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
-from newsapi import NewsApiClient # 뉴스 수집용 (가입 필요, 없으면 Mock 데이터 사용)
+from risk_keywords import RISK_KEYWORD_PATTERN
+from preamble_cache import save_preamble_state, restore_preamble_state
 
 # ==========================================
 # 1. 설정 (Configuration)
 # ==========================================
 MODEL_PATH = os.getenv("MODEL_PATH", "./models/qwen2.5-7b-instruct-q4_k_m.gguf")
-NEWS_API_KEY = os.getenv("NEWS_API_KEY", "YOUR_NEWS_API_KEY") # https://newsapi.org/ 에서 무료 키 발급 가능
+# 관련성/리스크 판단(분류) 단계용 모델. 정확도 민감도가 낮아 Q4_0, IQ3_XXS 등 저비트 양자화로 속도 확보
+MODEL_PATH_FILTER = os.getenv("MODEL_PATH_FILTER", MODEL_PATH)
+NEWS_API_KEY = os.getenv("NEWS_API_KEY", "YOUR_NEWS_API_KEY") # https://newsapi.org/ 에서 무료 키 발급 가능 (없으면 Mock 데이터 사용)
+NEWS_API_URL = "https://newsapi.org/v2/top-headlines"
+NEWS_QUERIES = ["economy", "banking", "credit", "fx"] # 동시에 요청할 뉴스 검색 키워드
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "./.llm_cache") # 필터/분석 응답 디스크 캐시 경로
+LLM_CACHE_TTL = 7 * 24 * 60 * 60 # LLM 응답 캐시 보관 기간 (초)
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2") # 의미 캐시용 문장 임베딩 모델
+SEMANTIC_CACHE_THRESHOLD = 0.92 # 이 코사인 유사도 이상이면 같은 기사로 간주
+SEEN_ARTICLE_TTL = 24 * 60 * 60 # 이미 처리한 기사를 다시 처리하지 않는 기간 (초)
+# 처리가 끝난 것으로 보는 기사 처리 결과 (그 외 오류/파싱 실패는 다음 스캔에서 재시도)
+COMPLETED_STATUSES = {"irrelevant", "safe", "already_alerted", "alerted"}
+TRANSLATOR_PATH = os.getenv("TRANSLATOR_PATH", "./models/opus-mt-en-ko-ct2") # CTranslate2로 변환한 번역 모델
+TRANSLATOR_TOKENIZER = os.getenv("TRANSLATOR_TOKENIZER", "Helsinki-NLP/opus-mt-en-ko")
+SHORT_CONTENT_LENGTH = 200 # 본문이 이보다 짧으면 LLM 요약 대신 번역만 수행
 
 # 하드웨어 설정 (RTX 4060 8GB 최적화)
 n_gpu_layers = -1  # 모든 레이어를 GPU에 할당
 n_ctx = 4096       # 컨텍스트 윈도우
+n_batch = 512      # prefill 배치 크기
+temperature = 0.1  # 분석용이므로 낮은 온도로 설정 (Fact 위주)
+
+# 단계별 사용 모델 및 최대 생성 토큰 수 (JSON 평가는 짧게, 한국어 요약만 길게)
+STAGE_MODEL_PATHS = {"assessment": MODEL_PATH_FILTER, "summary": MODEL_PATH}
+MAX_TOKENS = {"assessment": 64, "summary": 512}
+# 단계별 종료 문자열: JSON은 닫는 중괄호에서, 요약은 양식 마지막 줄의 [END] 표시에서 디코딩 중단
+# [END]를 빠뜨린 경우에도 프롬프트 끝부분(Risk Type/Headline/Content 입력 줄)을 흉내 내며 다음 기사를 이어 쓰기 시작하면 중단
+STOP_SEQUENCES = {"assessment": ["}"], "summary": ["[END]", "\nRisk Type:", "\nHeadline:", "\nContent:"]}
 
 # ==========================================
 # 2. 모델 로드 (Initialize LLM)
 # ==========================================
 print(">>> Loading AI Model... (This may take a moment)")
-llm = LlamaCpp(
-    model_path=MODEL_PATH,
-    n_gpu_layers=n_gpu_layers,
-    n_ctx=n_ctx,
-    temperature=0.1, # 분석용이므로 낮은 온도로 설정 (Fact 위주)
-    max_tokens=512,
-    verbose=False
-)
+# LangChain 래퍼 대신 llama_cpp를 직접 사용
+# 직전 호출과 앞부분이 같은 프롬프트는 해당 구간의 KV 캐시를 재사용하므로 prefill을 건너뜀
+def load_llm(model_path):
+    return Llama(
+        model_path=model_path,
+        n_gpu_layers=n_gpu_layers,
+        n_ctx=n_ctx,
+        n_batch=n_batch,
+        flash_attn=True,
+        verbose=False
+    )
+
+# 같은 모델 파일이면 인스턴스를 하나만 로드 (VRAM 8GB에 7B 모델 두 개는 빠듯함)
+llms = {model_path: load_llm(model_path) for model_path in set(STAGE_MODEL_PATHS.values())}
 print(">>> Model Loaded Successfully.")
 
-# ==========================================
-# 3. 프롬프트 정의 (Prompts)
-# ==========================================
+# Llama 인스턴스는 스레드 안전하지 않으므로 인스턴스별로 디코딩은 한 번에 하나씩 수행
+# (기사별 작업은 asyncio.to_thread로 동시에 돌리고, 파싱/캐시 조회 등은 디코딩과 겹쳐서 진행됨)
+llm_locks = {model_path: threading.Lock() for model_path in llms}
 
-# Step 1: 1차 필터링 (관련성 체크)
-filter_template = """
-You are a Financial News Filter. Analyze the headline below.
-Determine if it is potentially related to 'Credit Risk', 'Market Risk', 'Macroeconomics', or 'Banking'.
-Ignore sports, entertainment, and general crimes.
+def invoke(prompt, stage):
+    """단계(stage)별 모델, 토큰 한도, 문법(grammar), 종료 문자열을 적용하여 LLM을 호출하고 생성된 텍스트만 반환합니다."""
+    model_path = STAGE_MODEL_PATHS[stage]
+    stop = STOP_SEQUENCES.get(stage)
+    with llm_locks[model_path]:
+        restore_preamble_state(llms[model_path], preamble_states[stage])
+        res = llms[model_path].create_completion(
+            prompt,
+            max_tokens=MAX_TOKENS[stage],
+            temperature=temperature,
+            grammar=GRAMMARS.get(stage),
+            stop=stop
+        )
+    choice = res["choices"][0]
+    text = choice["text"]
 
-Headline: "{headline}"
+    # 종료 문자열은 결과에 포함되지 않으므로 JSON의 닫는 중괄호는 다시 붙여줌
+    if stop and "}" in stop and choice["finish_reason"] == "stop":
+        text += "}"
+    return text
 
-Return ONLY a JSON object strictly in this format:
-{{"is_relevant": true, "reason": "reason"}}
-or
-{{"is_relevant": false, "reason": "reason"}}
-"""
-filter_prompt = PromptTemplate(template=filter_template, input_variables=["headline"])
-
-# Step 2: 2차 심층 분석 (리스크 평가)
-analysis_template = """
-You are a Senior Risk Analyst. Analyze this news for potential impact on a commercial bank.
-
-Headline: "{headline}"
-Content Snippet: "{content}"
-
-Analyze step-by-step:
-1. Is this a Market Risk (interest rates, FX, stocks)?
-2. Is this a Credit Risk (bankruptcy, debt crisis)?
-3. Is the impact High or Medium?
-
-Return ONLY a JSON object strictly in this format:
-{{
-  "risk_type": "Market Risk" or "Credit Risk" or "None",
-  "impact_level": "High" or "Medium" or "Low",
-  "send_alert": true or false
-}}
-(Set 'send_alert' to true ONLY if impact is High or Medium)
-"""
-analysis_prompt = PromptTemplate(template=analysis_template, input_variables=["headline", "content"])
+# 10분 주기 스캔마다 겹치는 헤드라인이 많으므로 관련성/리스크 평가 결과를 디스크에 캐싱
+llm_cache = diskcache.Cache(LLM_CACHE_DIR)
+
+def make_cache_key(*parts):
+    """온도를 포함한 SHA256 캐시 키 (설정이 바뀌면 기존 캐시는 자동으로 무시됨)"""
+    raw = "\x00".join(str(part) for part in (temperature,) + parts)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def cached_invoke(prompt, stage, parse):
+    """
+    동일한 프롬프트에 대해서는 LLM을 다시 호출하지 않고 캐시된 응답을 사용합니다.
+    응답을 parse 한 결과를 반환하며, 파싱에 실패한 응답은 캐싱하지 않습니다. (다음 스캔에서 재시도)
+    """
+    key = make_cache_key(STAGE_MODEL_PATHS[stage], stage, MAX_TOKENS[stage], GBNF.get(stage), prompt)
+    res = llm_cache.get(key)
+    if res is not None:
+        return parse(res)
+    res = invoke(prompt, stage)
+    parsed = parse(res)
+    if parsed is not None:
+        llm_cache.set(key, res, expire=LLM_CACHE_TTL)
+    return parsed
+
+# 짧은 기사는 요약할 내용이 없으므로 LLM 대신 CPU 번역 모델로 번역만 수행 (수십 ms)
+# 번역 모델은 별도 변환 과정이 필요한 선택 사항이므로 처음 쓸 때 로드하고, 없으면 LLM 요약을 사용
+translator_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def load_translator():
+    """번역 모델과 토크나이저를 로드합니다. 사용할 수 없으면 None을 반환합니다. (1회만 시도)"""
+    try:
+        import ctranslate2
+        from transformers import AutoTokenizer
+        print(">>> Loading Translation Model...")
+        return ctranslate2.Translator(TRANSLATOR_PATH, device="cpu"), AutoTokenizer.from_pretrained(TRANSLATOR_TOKENIZER)
+    except Exception as e:
+        print(f"[Info] Translation model unavailable, using LLM summary for short articles. ({e})")
+        return None
+
+def translate(texts):
+    """영어 문장 목록을 한국어로 번역합니다. 번역 모델이 없으면 None을 반환합니다."""
+    with translator_lock:
+        loaded = load_translator()
+    if loaded is None:
+        return None
+    translator, tokenizer = loaded
+    batch = [tokenizer.convert_ids_to_tokens(tokenizer.encode(text)) for text in texts]
+    results = translator.translate_batch(batch)
+    return [
+        tokenizer.decode(tokenizer.convert_tokens_to_ids(result.hypotheses[0]), skip_special_tokens=True)
+        for result in results
+    ]
+
+# 통신사 기사는 표현만 바꿔 재배포되는 경우가 많아 정확히 일치하는 캐시로는 잡히지 않음
+# -> 헤드라인 임베딩이 충분히 비슷하면 이전 판정 결과를 그대로 재사용
+print(">>> Loading Embedding Model...")
+embedder = SentenceTransformer(EMBEDDING_MODEL)
 
-# Step 3: 요약 및 번역 (최종 아웃풋)
-summary_template = """
-You are an AI Executive Assistant.
-Summarize the following financial news into a Korean briefing format.
+class SemanticCache:
+    """헤드라인 임베딩(FAISS)으로 이전 평가 결과를 찾는 의미 기반 캐시"""
 
-Headline: "{headline}"
-Content: "{content}"
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEEN_ARTICLE_TTL):
+        self.threshold = threshold
+        self.ttl = ttl  # 이 기간이 지난 항목은 재사용하지 않음 (같은 유형의 새 사건이 경보 없이 묻히지 않도록)
+        # 정규화된 벡터의 내적 = 코사인 유사도
+        self.index = faiss.IndexFlatIP(embedder.get_sentence_embedding_dimension())
+        self.vectors = []  # 만료 항목 제거 시 index를 다시 만들기 위해 보관
+        self.entries = []  # index에 추가된 순서대로 {"risk_data": dict, "alerted": bool, "created_at": float}
 
-Output strictly in Korean(한국어) in this format:
+    def embed(self, headlines):
+        """헤드라인 목록을 L2 정규화된 임베딩 행렬로 변환합니다."""
+        vectors = embedder.encode(headlines, normalize_embeddings=True)
+        return np.asarray(vectors, dtype="float32")
 
-**[긴급] {risk_type} 조기 경보**
+    def is_expired(self, entry):
+        return time.time() - entry["created_at"] >= self.ttl
+
+    def prune(self):
+        """만료된 항목을 제거하고 남은 항목으로 index를 다시 만듭니다. (스캔마다 1회)"""
+        live = [(vector, entry) for vector, entry in zip(self.vectors, self.entries) if not self.is_expired(entry)]
+        if len(live) == len(self.entries):
+            return
+        self.index.reset()
+        self.vectors = [vector for vector, _ in live]
+        self.entries = [entry for _, entry in live]
+        if self.vectors:
+            self.index.add(np.stack(self.vectors))
+
+    def lookup(self, vector):
+        """가장 비슷한 헤드라인의 항목을 반환합니다. 유사도가 임계값 미만이거나 만료된 항목이면 None."""
+        if self.index.ntotal == 0:
+            return None
+        scores, ids = self.index.search(vector.reshape(1, -1), 1)
+        if scores[0][0] < self.threshold:
+            return None
+        entry = self.entries[ids[0][0]]
+        if self.is_expired(entry):
+            return None
+        return entry
+
+    def add(self, vector, entry):
+        entry["created_at"] = time.time()
+        self.index.add(vector.reshape(1, -1))
+        self.vectors.append(vector)
+        self.entries.append(entry)
+
+semantic_cache = SemanticCache()
+
+# ==========================================
+# 3. 프롬프트 정의 (Prompts)
+# ==========================================
+# 고정된 지시문을 앞에, 기사마다 바뀌는 헤드라인/본문을 맨 뒤에 배치 (KV 캐시 재사용)
+# 입력 토큰 절약을 위해 들여쓰기/빈 줄 없이 간결하게 작성 (한국어 출력 양식은 그대로 유지)
+
+# Step 1: 관련성 판단 + 리스크 평가 (한 번의 호출로 처리)
+# 관련 없는 기사도 같은 JSON 스키마로 답하게 하여 결과 형태를 고정
+assessment_template = """You are a bank risk analyst. Decide if this news relates to credit risk, market risk, macroeconomics or banking (ignore sports, entertainment, general crime). If relevant, set risk_type to Market Risk (rates, FX, stocks) or Credit Risk (bankruptcy, debt crisis), impact_level to High/Medium/Low, and send_alert=true only if High or Medium. If not relevant, use null for risk_type and impact_level and send_alert=false.
+Output: {{"is_relevant":bool,"risk_type":"Market Risk"|"Credit Risk"|null,"impact_level":"High"|"Medium"|"Low"|null,"send_alert":bool}}
+Headline:"{headline}"
+Content:"{content}"
+"""
+assessment_prompt = PromptTemplate(template=assessment_template, input_variables=["headline", "content"])
+
+# 평가 결과 JSON 스키마를 GBNF 문법으로 고정 -> 닫는 중괄호 직후 생성이 끝나고 항상 유효한 JSON이 나옴
+assessment_gbnf = r"""
+root ::= "{" ws "\"is_relevant\":" ws bool "," ws "\"risk_type\":" ws risk-type "," ws "\"impact_level\":" ws impact-level "," ws "\"send_alert\":" ws bool ws "}"
+bool ::= "true" | "false"
+risk-type ::= "\"Market Risk\"" | "\"Credit Risk\"" | "null"
+impact-level ::= "\"High\"" | "\"Medium\"" | "\"Low\"" | "null"
+ws ::= " "?
+"""
+
+# Step 2: 요약 및 번역 (최종 아웃풋)
+# 리스크 유형도 기사마다 바뀌므로 양식 안에 넣지 않고 뒤쪽 입력값으로 전달 (지시문 전체를 KV 캐시로 재사용)
+summary_template = """Summarize this financial news as a briefing, strictly in Korean(한국어), in this format:
+**[긴급] (Risk Type) 조기 경보**
 * **헤드라인:** (Korean Translation)
 * **핵심 요약:**
   - (Point 1)
   - (Point 2)
 * **리스크 요인:** (One sentence summary of the threat)
+[END]
+Risk Type:{risk_type}
+Headline:"{headline}"
+Content:"{content}"
 """
 summary_prompt = PromptTemplate(template=summary_template, input_variables=["headline", "content", "risk_type"])
 
+# 짧은 기사용 고정 양식 (번역 결과만 채워 넣음)
+short_summary_template = """**[긴급] {risk_type} 조기 경보**
+* **헤드라인:** {headline_kr}
+* **핵심 요약:**
+  - {content_kr}
+* **리스크 요인:** {risk_type} (영향도: {impact_level})"""
+# 고정 양식은 LLM을 거치지 않으므로 평가 결과의 영어 라벨을 한국어로 바꿔서 채움 (null이면 기본값)
+RISK_TYPE_KR = {"Market Risk": "시장 리스크", "Credit Risk": "신용 리스크"}
+IMPACT_LEVEL_KR = {"High": "높음", "Medium": "중간", "Low": "낮음"}
+
+# 단계별 출력 문법 (요약은 자유 형식이므로 문법 없음)
+GBNF = {"assessment": assessment_gbnf}
+GRAMMARS = {stage: LlamaGrammar.from_string(gbnf, verbose=False) for stage, gbnf in GBNF.items()}
+
+def static_prefix(prompt_template):
+    """템플릿에서 첫 입력값이 들어가기 전까지의 고정 앞부분(지시문)을 반환합니다."""
+    marker = "\x00"
+    filled = prompt_template.format(**{var: marker for var in prompt_template.input_variables})
+    return filled.split(marker)[0]
+
+# 단계별 지시문 KV 상태를 시작 시 한 번만 계산 (이후 호출은 복원 후 가변 부분만 처리)
+print(">>> Caching Prompt Preambles...")
+PREAMBLES = {"assessment": static_prefix(assessment_prompt), "summary": static_prefix(summary_prompt)}
+preamble_states = {
+    stage: save_preamble_state(llms[STAGE_MODEL_PATHS[stage]], preamble)
+    for stage, preamble in PREAMBLES.items()
+}
+
 # ==========================================
 # 4. 기능 함수 구현 (Functions)
 # ==========================================
 
-def fetch_news():
+async def fetch_query(session, query):
+    """뉴스 API에서 키워드 하나에 대한 최신 헤드라인을 가져옵니다."""
+    # 언어: en (영어), 실제 구현시에는 여러 언어 쿼리 필요
+    params = {"q": query, "language": "en", "pageSize": 5, "apiKey": NEWS_API_KEY}
+    async with session.get(NEWS_API_URL, params=params) as response:
+        data = await response.json()
+    if data.get("status") != "ok":
+        raise RuntimeError(data.get("message", f"HTTP {response.status}"))
+    return data.get("articles", [])
+
+async def fetch_news():
     """
-    뉴스 API를 통해 최신 뉴스를 가져옵니다.
+    뉴스 API에 여러 키워드 쿼리를 동시에 요청하여 최신 뉴스를 가져옵니다.
     API 키가 없거나 에러 발생 시 테스트용 Mock 데이터를 반환합니다.
     """
     try:
-        newsapi = NewsApiClient(api_key=NEWS_API_KEY)
-        # 키워드: bank, economy, credit, market, finance
-        # 언어: en (영어), 실제 구현시에는 여러 언어 쿼리 필요
-        top_headlines = newsapi.get_top_headlines(q='economy', language='en', page_size=5)
-        articles = top_headlines.get('articles', [])
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+            responses = await asyncio.gather(
+                *[fetch_query(session, query) for query in NEWS_QUERIES], return_exceptions=True
+            )
+        articles = [article for res in responses if not isinstance(res, Exception) for article in res]
         if articles:
             return articles
+        errors = [res for res in responses if isinstance(res, Exception)]
+        if errors:
+            raise errors[0]
     except Exception as e:
         print(f"[Info] API Call Failed or No Key. Using Mock Data. ({e})")
     
@@ -133,15 +327,46 @@ def fetch_news():
         }
     ]
 
+def fetch_news_sync():
+    """동기 코드에서 뉴스를 가져올 때 사용하는 fetch_news 래퍼입니다."""
+    return asyncio.run(fetch_news())
+
+# 응답 중 첫 번째 JSON 객체 (한 단계 중첩까지 허용)
+JSON_OBJECT_PATTERN = re.compile(r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}', re.S)
+
 def parse_json_response(response_text):
-    """LLM의 응답에서 JSON 부분만 추출하여 파싱합니다."""
+    """LLM의 응답에서 JSON 부분만 추출하여 파싱합니다. (앞뒤에 설명 문장이 붙어도 처리)"""
+    match = JSON_OBJECT_PATTERN.search(response_text)
+    if not match:
+        return None
     try:
-        # Markdown 코드 블록 제거 등 전처리
-        cleaned = response_text.replace("```json", "").replace("```", "").strip()
-        return json.loads(cleaned)
+        return json.loads(match.group(0))
     except json.JSONDecodeError:
         return None
 
+def article_keys(article):
+    """정규화한 제목과 URL로 기사 식별 키를 만듭니다. ("Fed Raises Rates!"와 "Fed raises rates"는 같은 키)"""
+    title = re.sub(r'\W+', ' ', article.get('title') or '').strip().lower()
+    keys = ["seen:title:" + hashlib.md5(title.encode()).hexdigest()]
+    if article.get('url'):
+        keys.append("seen:url:" + hashlib.md5(article['url'].encode()).hexdigest())
+    return keys
+
+def dedupe_articles(articles):
+    """
+    여러 매체가 같은 기사를 중복 송고하는 경우 제목 또는 URL이 같은 기사는 하나만 남깁니다.
+    이전 스캔에서 이미 처리한 기사(디스크 캐시에 기록됨)도 제외합니다.
+    """
+    unique = []
+    seen = set()
+    for article in articles:
+        keys = article_keys(article)
+        if any(key in seen or key in llm_cache for key in keys):
+            continue
+        seen.update(keys)
+        unique.append(article)
+    return unique
+
 def send_email_alert(subject, body, to_email="user@example.com"):
     """
     실제 이메일 발송 함수 (여기서는 출력으로 대체)
@@ -158,70 +383,160 @@ def send_email_alert(subject, body, to_email="user@example.com"):
 # 5. 메인 실행 로직 (Main Pipeline)
 # ==========================================
 
-def run_early_warning_system():
-    print(f"\n>>> Starting Scan at {datetime.now()}")
-    articles = fetch_news()
-    
-    for article in articles:
-        headline = article.get('title')
-        content = article.get('description') or headline
-        url = article.get('url')
-        
-        print(f"\nProcessing: {headline[:50]}...")
+async def process_article(article, vector, entry):
+    """
+    기사 1건에 대해 관련성/리스크 평가(Step 1)와 요약/발송(Step 2)을 수행합니다.
+    entry는 의미 캐시에서 찾은 비슷한 기사의 항목이며, 없으면 None 입니다.
+    처리 결과를 "parse_error", "assessment_error", "irrelevant", "safe", "already_alerted",
+    "summary_error", "alerted" 중 하나로 반환합니다.
+    """
+    headline = article.get('title')
+    content = article.get('description') or headline
+    url = article.get('url')
+    tag = f"[{headline[:30]}...]"
+
+    # --- Step 1: 관련성 판단 + 리스크 평가 ---
+    try:
+        if entry is None:
+            risk_data = await asyncio.to_thread(
+                cached_invoke,
+                assessment_prompt.format(headline=headline, content=content),
+                "assessment",
+                parse_json_response
+            )
+            if risk_data:
+                entry = {"risk_data": risk_data, "alerted": False}
+                semantic_cache.add(vector, entry)
+        else:
+            risk_data = entry["risk_data"]
+
+        if not risk_data:
+            print(f"   -> {tag} [Skipped] Parse Error")
+            return "parse_error"
+
+        if not risk_data.get('is_relevant'):
+            print(f"   -> {tag} [Skipped] Irrelevant")
+            return "irrelevant"
         
-        # --- Step 1: 1차 필터링 ---
-        try:
-            filter_res_raw = llm.invoke(filter_prompt.format(headline=headline))
-            filter_data = parse_json_response(filter_res_raw)
-            
-            if not filter_data or not filter_data.get('is_relevant'):
-                print(f"   -> [Skipped] Irrelevant ({filter_data.get('reason') if filter_data else 'Parse Error'})")
-                continue
-        except Exception as e:
-            print(f"   -> [Error] Filter Step: {e}")
-            continue
+        if not risk_data.get('send_alert'):
+            print(f"   -> {tag} [Safe] Low Risk or None ({risk_data.get('risk_type')})")
+            return "safe"
 
-        print("   -> [Relevant] Proceeding to Deep Analysis...")
-
-        # --- Step 2: 2차 심층 분석 ---
-        try:
-            analysis_res_raw = llm.invoke(analysis_prompt.format(headline=headline, content=content))
-            risk_data = parse_json_response(analysis_res_raw)
-            
-            if not risk_data or not risk_data.get('send_alert'):
-                print(f"   -> [Safe] Low Risk or None ({risk_data.get('risk_type') if risk_data else 'Parse Error'})")
-                continue
-            
-            risk_type = risk_data.get('risk_type')
-            impact_level = risk_data.get('impact_level')
-            print(f"   -> [ALERT] {impact_level} Impact {risk_type} Detected!")
-            
-        except Exception as e:
-            print(f"   -> [Error] Analysis Step: {e}")
-            continue
+        # 표현만 다른 같은 기사로 이미 경보를 보냈으면 중복 발송하지 않음
+        if entry["alerted"]:
+            print(f"   -> {tag} [Skipped] Similar story already alerted")
+            return "already_alerted"
+        
+        risk_type = risk_data.get('risk_type')
+        impact_level = risk_data.get('impact_level')
+        print(f"   -> {tag} [ALERT] {impact_level} Impact {risk_type} Detected!")
+        
+    except Exception as e:
+        print(f"   -> {tag} [Error] Assessment Step: {e}")
+        return "assessment_error"
 
-        # --- Step 3: 요약 및 발송 ---
-        try:
-            summary_res = llm.invoke(summary_prompt.format(
+    # --- Step 2: 요약 및 발송 ---
+    try:
+        summary_res = None
+        if len(content) < SHORT_CONTENT_LENGTH:
+            # 짧은 기사: 번역 후 고정 양식에 채워 넣음 (LLM 디코딩 생략)
+            try:
+                translated = await asyncio.to_thread(translate, [headline, content])
+            except Exception as e:
+                print(f"   -> {tag} [Info] Translation failed, using LLM summary ({e})")
+                translated = None
+            if translated:
+                headline_kr, content_kr = translated
+                summary_res = short_summary_template.format(
+                    risk_type=RISK_TYPE_KR.get(risk_type, "금융 리스크"),
+                    impact_level=IMPACT_LEVEL_KR.get(impact_level, "미상"),
+                    headline_kr=headline_kr,
+                    content_kr=content_kr
+                )
+        if summary_res is None:
+            summary_res = await asyncio.to_thread(invoke, summary_prompt.format(
                 headline=headline, 
                 content=content,
                 risk_type=risk_type
-            ))
-            
-            # 이메일 본문 완성
-            final_email_body = f"{summary_res}\n\n[Original Source]: {url}"
-            send_email_alert(f"[Risk Alert] {risk_type} Detected", final_email_body)
-            
-        except Exception as e:
-            print(f"   -> [Error] Summary Step: {e}")
+            ), "summary")
+            summary_res = summary_res.strip()
+        
+        # 이메일 본문 완성
+        final_email_body = f"{summary_res}\n\n[Original Source]: {url}"
+        send_email_alert(f"[Risk Alert] {risk_type} Detected", final_email_body)
+        entry["alerted"] = True
+        return "alerted"
+        
+    except Exception as e:
+        print(f"   -> {tag} [Error] Summary Step: {e}")
+        return "summary_error"
+
+async def run_early_warning_system():
+    print(f"\n>>> Starting Scan at {datetime.now()}")
+    articles = await fetch_news()
+
+    # --- Step 0-1: 중복 기사 제거 (같은 스캔 내 중복 + 이전 스캔에서 처리한 기사) ---
+    unique_articles = dedupe_articles(articles)
+    if len(unique_articles) < len(articles):
+        print(f">>> Skipped {len(articles) - len(unique_articles)} duplicate or already processed article(s)")
+    articles = unique_articles
+
+    # --- Step 0-2: 키워드 사전 필터 (금융 용어가 하나도 없는 기사는 LLM 호출 없이 제외) ---
+    candidates = []
+    for article in articles:
+        text = f"{article.get('title')} {article.get('description') or ''}"
+        if RISK_KEYWORD_PATTERN.search(text):
+            candidates.append(article)
+        else:
+            print(f"\nProcessing: {article.get('title')[:50]}...")
+            print("   -> [Skipped] No financial keywords")
+    articles = candidates
+
+    headlines = [article.get('title') for article in articles]
+
+    # --- Step 0-3: 의미 캐시 조회 (비슷한 헤드라인을 이미 처리했으면 재사용) ---
+    semantic_cache.prune()
+    vectors = await asyncio.to_thread(semantic_cache.embed, headlines)
+
+    # 같은 스캔 안의 재배포 기사는 아직 의미 캐시에 없으므로, 먼저 처리할 기사들과 직접 비교하여 제외
+    tasks = []
+    dispatched = []
+    dispatched_vectors = []
+    for article, vector in zip(articles, vectors):
+        print(f"\nProcessing: {article.get('title')[:50]}...")
+
+        if dispatched_vectors and (np.array(dispatched_vectors) @ vector).max() >= SEMANTIC_CACHE_THRESHOLD:
+            print("   -> [Skipped] Similar to another article in this scan")
+            continue
+
+        entry = semantic_cache.lookup(vector)
+        if entry is not None:
+            print("   -> [Cache] Similar headline already processed")
+
+        dispatched.append(article)
+        dispatched_vectors.append(vector)
+        tasks.append(process_article(article, vector, entry))
+    articles = dispatched
+
+    # --- Step 1~2: 기사들을 동시에 처리 ---
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for article, result in zip(articles, results):
+        if isinstance(result, Exception):
+            print(f"   -> [Error] Article Pipeline: {result}")
+            continue
+        # 평가가 끝났고, 경보 대상이면 실제로 발송까지 된 기사만 다음 스캔에서 제외하도록 기록
+        if result not in COMPLETED_STATUSES:
+            continue
+        for key in article_keys(article):
+            llm_cache.set(key, True, expire=SEEN_ARTICLE_TTL)
 
 if __name__ == "__main__":
     # 테스트를 위해 1회 실행
-    run_early_warning_system()
+    asyncio.run(run_early_warning_system())
     
     # 주기적 실행을 원하면 아래 주석 해제 (ex: 10분마다)
     # import schedule
-    # schedule.every(10).minutes.do(run_early_warning_system)
+    # schedule.every(10).minutes.do(lambda: asyncio.run(run_early_warning_system()))
     # while True:
     #     schedule.run_pending()
     #     time.sleep(1)
@@ -1,11 +1,13 @@
 import os
+import re
 import json
-from typing import TypedDict, List, Annotated
+from typing import TypedDict, List, Annotated, Optional
 from newsapi import NewsApiClient
-from langchain_community.llms import LlamaCpp
-from langchain.prompts import PromptTemplate
+from llama_cpp import Llama, LlamaGrammar
 from langchain_core.messages import HumanMessage
 from langgraph.graph import StateGraph, END
+from risk_keywords import RISK_KEYWORD_PATTERN
+from preamble_cache import save_preamble_state, restore_preamble_state
 
 # ==========================================
 # 1. Configuration & Model
@@ -13,17 +15,82 @@ from langgraph.graph import StateGraph, END
 # .env에서 로드하거나 직접 입력
 NEWS_API_KEY = os.getenv("NEWS_API_KEY", "YOUR_KEY_HERE")
 MODEL_PATH = os.getenv("MODEL_PATH", "./models/qwen2.5-7b-instruct-q4_k_m.gguf")
+# 1차 필터링 전용 모델 (분류만 하므로 Q4_0, IQ3_XXS 등 저비트 양자화 사용 가능)
+MODEL_PATH_FILTER = os.getenv("MODEL_PATH_FILTER", MODEL_PATH)
 
 # 모델 로드 (전역 인스턴스)
 # n_gpu_layers=-1 : 모든 레이어를 GPU에 할당 (RTX 4060 필수)
-llm = LlamaCpp(
-    model_path=MODEL_PATH,
-    n_gpu_layers=-1, 
-    n_ctx=4096,
-    temperature=0.1,
-    max_tokens=1024,
-    verbose=False
-)
+# LangChain 래퍼 대신 llama_cpp 직접 사용: 직전 프롬프트와 겹치는 앞부분은 KV 캐시 재사용
+def load_llm(model_path: str) -> Llama:
+    return Llama(
+        model_path=model_path,
+        n_gpu_layers=-1, 
+        n_ctx=4096,
+        n_batch=512,
+        flash_attn=True,
+        verbose=False
+    )
+
+llm = load_llm(MODEL_PATH)
+# 같은 파일이면 인스턴스 공유 (VRAM 절약)
+filter_llm = llm if MODEL_PATH_FILTER == MODEL_PATH else load_llm(MODEL_PATH_FILTER)
+
+# 단계별 최대 생성 토큰 수 (filter는 헤드라인 1개당 토큰 수)
+MAX_TOKENS = {"filter": 8, "analysis": 256, "report": 1024}
+
+# 구조화된 출력 단계는 GBNF 문법으로 형식을 강제 (형식이 끝나면 바로 생성 종료)
+FILTER_GBNF = r"""
+root ::= row+
+row ::= [0-9]+ "|" ("true" | "false") "\n"
+"""
+ANALYSIS_GBNF = r"""
+root ::= "{" ws "\"risk_type\":" ws risk-type "," ws "\"impact\":" ws impact "," ws "\"summary\":" ws string ws "}"
+risk-type ::= "\"Market Risk\"" | "\"Credit Risk\"" | "\"None\""
+impact ::= "\"High\"" | "\"Medium\"" | "\"Low\""
+string ::= "\"" ([^"\\\x7F\x00-\x1F] | "\\" ["\\/bfnrt])* "\""
+ws ::= " "?
+"""
+GRAMMARS = {
+    "filter": LlamaGrammar.from_string(FILTER_GBNF, verbose=False),
+    "analysis": LlamaGrammar.from_string(ANALYSIS_GBNF, verbose=False),
+}
+
+def stage_llm(stage: str) -> Llama:
+    return filter_llm if stage == "filter" else llm
+
+def invoke(prompt: str, stage: str, max_tokens: Optional[int] = None) -> str:
+    """단계별 모델/토큰 한도/문법을 적용하여 LLM 호출 후 생성 텍스트만 반환"""
+    model = stage_llm(stage)
+    restore_preamble_state(model, preamble_states[stage])
+    res = model.create_completion(
+        prompt,
+        max_tokens=max_tokens or MAX_TOKENS[stage],
+        temperature=0.1,
+        grammar=GRAMMARS.get(stage)
+    )
+    return res["choices"][0]["text"]
+
+# 프롬프트는 모듈 로드 시 한 번만 구성하고, 호출 시에는 고정 앞/뒷부분에 입력값만 이어 붙임
+# (노드 실행마다 PromptTemplate 생성/검증, format 비용이 들지 않음)
+# 행마다 JSON 객체를 반복하는 대신 "id|is_relevant" 행으로 받아 출력 토큰 절약
+FILTER_TEMPLATE = """Is each numbered headline related to financial risk, banking or economy? For every headline write one line "<id>|true" or "<id>|false", no header.
+Headlines:
+{headlines}
+Output:
+"""
+FILTER_PREFIX, FILTER_SUFFIX = FILTER_TEMPLATE.split("{headlines}")
+
+ANALYSIS_TEMPLATE = """Analyze for credit/market risk. Output: {"risk_type":"Market Risk"|"Credit Risk"|"None","impact":"High"|"Medium"|"Low","summary":"short Korean summary"}
+Headline:"{headline}"
+Content:"{content}"
+"""
+ANALYSIS_PREFIX, ANALYSIS_MIDDLE, ANALYSIS_SUFFIX = re.split(r"\{headline\}|\{content\}", ANALYSIS_TEMPLATE)
+
+REPORT_PREFIX = "Write one cohesive email alert in Korean with clear bullet points from these risk analyses:\n"
+
+# 단계별 지시문(PREFIX)의 KV 상태를 시작 시 한 번만 계산
+PREAMBLES = {"filter": FILTER_PREFIX, "analysis": ANALYSIS_PREFIX, "report": REPORT_PREFIX}
+preamble_states = {stage: save_preamble_state(stage_llm(stage), preamble) for stage, preamble in PREAMBLES.items()}
 
 # ==========================================
 # 2. Define State (Graph State)
@@ -56,30 +123,52 @@ def fetch_news_node(state: AgentState):
     
     return {"raw_headlines": articles}
 
+def batch_filter(headlines: List[str], k: int = 6) -> List[bool]:
+    """헤드라인 k개를 하나의 프롬프트로 묶어 관련성 판단 (4~8개 권장)"""
+    verdicts = []
+    for start in range(0, len(headlines), k):
+        chunk = headlines[start:start + k]
+        numbered = "\n".join(f"{i}. {headline}" for i, headline in enumerate(chunk, 1))
+        results = {}
+        try:
+            # 행당 "id|true" 몇 토큰이면 충분하므로 디코딩 길이를 헤드라인 수에 맞춰 제한
+            res = invoke(FILTER_PREFIX + numbered + FILTER_SUFFIX, "filter", max_tokens=MAX_TOKENS["filter"] * len(chunk))
+            for row in res.strip().splitlines():
+                cells = [cell.strip() for cell in row.split("|")]
+                # 이 묶음에 없는 번호(범위 밖 id)는 무시하여 누락된 판정이 가려지지 않도록 함
+                if len(cells) >= 2 and cells[0].isdigit() and 1 <= int(cells[0]) <= len(chunk):
+                    results[int(cells[0])] = cells[1].lower() == "true"
+        except Exception as e:
+            print(f"  -> [Error] Filter Batch: {e}")
+        missing = len(chunk) - len(results)
+        if missing:
+            print(f"  -> [Warning] {missing} headline(s) without a verdict, treated as irrelevant")
+        # 파싱 실패한 항목은 관련 없음으로 처리
+        verdicts.extend(results.get(i, False) for i in range(1, len(chunk) + 1))
+    return verdicts
+
 def filter_news_node(state: AgentState):
-    """1차 필터링 노드 (배치 처리가 아닌 순차 처리 예시)"""
+    """1차 필터링 노드 (헤드라인을 묶어서 배치 처리)"""
     print("--- [Step 2] Filtering News ---")
     raw_news = state['raw_headlines']
     relevant_news = []
 
-    filter_prompt = PromptTemplate(
-        template="""Check if this headline is related to 'Financial Risk', 'Banking', or 'Economy'.
-        Headline: "{headline}"
-        Return JSON: {{"is_relevant": true/false}}""",
-        input_variables=["headline"]
-    )
-
+    # 키워드 사전 필터를 통과한 헤드라인만 LLM으로 판단
+    candidates = []
     for news in raw_news:
-        try:
-            res = llm.invoke(filter_prompt.format(headline=news['title']))
-            # JSON 파싱 (단순화)
-            if '"is_relevant": true' in res.lower():
-                relevant_news.append(news)
-                print(f"  -> Relevant: {news['title'][:30]}...")
-            else:
-                print(f"  -> Skipped: {news['title'][:30]}...")
-        except:
-            continue
+        if RISK_KEYWORD_PATTERN.search(f"{news['title']} {news.get('description') or ''}"):
+            candidates.append(news)
+        else:
+            print(f"  -> Skipped (no keywords): {news['title'][:30]}...")
+
+    verdicts = batch_filter([news['title'] for news in candidates])
+
+    for news, is_relevant in zip(candidates, verdicts):
+        if is_relevant:
+            relevant_news.append(news)
+            print(f"  -> Relevant: {news['title'][:30]}...")
+        else:
+            print(f"  -> Skipped: {news['title'][:30]}...")
             
     return {"relevant_news": relevant_news}
 
@@ -89,24 +178,10 @@ def analyze_risk_node(state: AgentState):
     relevant_news = state['relevant_news']
     analyzed_risks = []
 
-    analysis_prompt = PromptTemplate(
-        template="""Analyze for Credit/Market Risk.
-        Headline: "{headline}"
-        Content: "{content}"
-        
-        Return JSON format:
-        {{
-            "risk_type": "Market Risk/Credit Risk/None",
-            "impact": "High/Medium/Low",
-            "summary": "Short summary in Korean"
-        }}
-        """,
-        input_variables=["headline", "content"]
-    )
-
     for news in relevant_news:
         content = news.get('description') or news['title']
-        res = llm.invoke(analysis_prompt.format(headline=news['title'], content=content))
+        prompt = ANALYSIS_PREFIX + news['title'] + ANALYSIS_MIDDLE + content + ANALYSIS_SUFFIX
+        res = invoke(prompt, "analysis")
         
         # 실제 구현에선 견고한 JSON Parser 필요
         # 여기서는 LLM이 JSON 포맷을 잘 지킨다고 가정하고 텍스트 처리
@@ -129,15 +204,9 @@ def report_node(state: AgentState):
     # 최종 보고서 작성 프롬프트
     input_text = "\n".join([str(r['analysis']) for r in risks])
     
-    writer_prompt = f"""
-    Based on the following risk analyses, write a cohesive email alert in Korean.
-    Format clearly with bullet points.
-    
-    Analyses:
-    {input_text}
-    """
+    writer_prompt = REPORT_PREFIX + input_text
     
-    email_body = llm.invoke(writer_prompt)
+    email_body = invoke(writer_prompt, "report")
     
     # 여기서 실제 이메일 발송 로직 수행 (SMTP)
     print("\n========== [FINAL EMAIL] ==========")
@@ -0,0 +1,45 @@
+import ctypes
+import llama_cpp
+
+# 단계별 고정 지시문(preamble)의 KV 캐시 스냅샷 (early_warning_system.py, main.py 공용)
+# llama-cpp-python의 비공개 속성(_ctx.ctx, _input_ids, n_tokens)을 직접 다루므로 pyproject.toml에 고정한 버전 기준으로 작성
+# 버전이 바뀌어 해당 속성/함수가 없으면 스냅샷 없이 동작 (create_completion의 자동 접두어 재사용만 사용)
+
+def save_preamble_state(llm, preamble):
+    """
+    고정 지시문만 미리 평가한 뒤 해당 시퀀스의 KV 캐시만 복사해 둡니다. (시작 시 단계별로 1회)
+    Llama.save_state()는 n_batch x n_vocab 크기의 로짓 버퍼까지 복사하므로 사용하지 않습니다.
+    스냅샷을 만들 수 없으면 None을 반환합니다.
+    """
+    try:
+        tokens = llm.tokenize(preamble.encode("utf-8"), special=True)
+        llm.reset()
+        llm.eval(tokens)
+        ctx = llm._ctx.ctx
+        llm._input_ids  # 복원 시 사용하는 속성도 미리 확인
+        size = llama_cpp.llama_state_seq_get_size(ctx, 0)
+        buffer = (ctypes.c_uint8 * size)()
+        written = llama_cpp.llama_state_seq_get_data(ctx, buffer, size, 0)
+    except AttributeError as e:
+        print(f"[Info] Preamble KV snapshot unavailable in this llama-cpp-python version. ({e})")
+        llm.reset()
+        return None
+    return buffer, written, tokens
+
+def restore_preamble_state(llm, state):
+    """
+    save_preamble_state로 만든 지시문 KV 캐시를 복원합니다.
+    복원 후 create_completion은 지시문과 겹치는 토큰을 건너뛰고 가변 부분만 prefill 합니다.
+    """
+    if state is None:
+        return
+    buffer, size, tokens = state
+    # 직전 호출이 같은 단계였다면 이미 같은 지시문이 KV 캐시에 있으므로 복원 불필요
+    if llm.n_tokens >= len(tokens) and llm.input_ids[:len(tokens)].tolist() == tokens:
+        return
+    if llama_cpp.llama_state_seq_set_data(llm._ctx.ctx, buffer, size, 0) == 0:
+        # 복원 실패 시 처음부터 prefill
+        llm.reset()
+        return
+    llm._input_ids[:len(tokens)] = tokens
+    llm.n_tokens = len(tokens)
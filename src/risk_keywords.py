@@ -0,0 +1,22 @@
+import re
+
+# 금융 리스크 기사 키워드 사전 필터 (early_warning_system.py, main.py 공용)
+# LLM 판단을 보조할 뿐이므로 재현율 우선: 애매한 기사는 통과시키고 LLM이 최종 판단
+# 'rates', 'bankruptcy', 'liquidated' 등 파생어도 잡도록 접두어로 매칭하는 용어
+RISK_KEYWORD_PREFIXES = [
+    "bank", "inflation", "deflation", "rate", "interest", "debt", "bond", "loan", "mortgage", "credit",
+    "bankrupt", "default", "insolv", "liquidat", "collaps", "bailout", "downgrad", "yield", "currenc",
+    "exchange rate", "market", "recession", "econom", "stock", "share", "treasur", "tariff", "sanction",
+    "crisis", "price", "commodit", "deficit", "layoff", "unemploy", "export", "devalu",
+]
+# 접두어로 매칭하면 엉뚱한 단어가 걸리는 약어/짧은 용어 ('fed' -> 'Federer')는 단어 단위로 매칭 (복수형 허용)
+RISK_KEYWORD_WORDS = [
+    "fed", "ecb", "boj", "imf", "opec", "fx", "gdp", "cpi", "ipo", "central bank",
+    "dollar", "euro", "yen", "yuan", "won", "oil", "crude", "gold",
+]
+
+RISK_KEYWORD_PATTERN = re.compile(
+    r"\b(?:(?:" + "|".join(map(re.escape, RISK_KEYWORD_PREFIXES)) + r")\w*"
+    r"|(?:" + "|".join(map(re.escape, RISK_KEYWORD_WORDS)) + r")s?\b)",
+    re.I
+)